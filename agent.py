@@ -1,7 +1,11 @@
 # agent.py
+import asyncio
+import functools
+import hashlib
 import os
-import json
-from datetime import date
+import threading
+from collections import defaultdict
+from datetime import date, datetime
 from typing import Optional
 
 # ADK Imports for agent and tool definition
@@ -9,11 +13,15 @@ from google.adk.agents import LlmAgent
 from google.adk.tools import FunctionTool, ToolContext, AgentTool
 from google.adk.auth import AuthConfig, AuthCredential, AuthCredentialTypes, OAuth2Auth
 from fastapi.openapi import models as openapi_models
+import orjson
 
 # Google API Client Imports
+import google_auth_httplib2
+import httplib2
+import requests
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+from googleapiclient.discovery import Resource, build
 from googleapiclient.errors import HttpError
 
 # --- Configuration ---
@@ -21,6 +29,11 @@ from googleapiclient.errors import HttpError
 GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.environ.get("GOOGLE_CLIENT_SECRET")
 TOKEN_CACHE_KEY = "google_chat_user_tokens"
+# Refresh tokens this many seconds before they expire, so a tool call never
+# starts with a token that dies mid-request.
+TOKEN_REFRESH_LEEWAY_SECS = int(os.environ.get("TOKEN_REFRESH_LEEWAY_SECS", "60"))
+# Cap on spaces returned to the LLM; more than this is rarely useful in context.
+MAX_SPACE_RESULTS = int(os.environ.get("MAX_SPACE_RESULTS", "50"))
 SCOPES = [
     "https://www.googleapis.com/auth/chat.spaces.readonly",
     "https://www.googleapis.com/auth/chat.messages.readonly",
@@ -41,6 +54,76 @@ auth_credential = AuthCredential(
     auth_type=AuthCredentialTypes.OAUTH2,
     oauth2=OAuth2Auth(client_id=GOOGLE_CLIENT_ID, client_secret=GOOGLE_CLIENT_SECRET),
 )
+# Both inputs are module-level constants, so validate the AuthConfig once
+# instead of re-running pydantic validation on every get_credentials call.
+_AUTH_CONFIG = AuthConfig(auth_scheme=auth_scheme, raw_auth_credential=auth_credential)
+
+# A fresh Request() builds a new requests.Session per refresh; sharing one
+# session keeps a pooled keepalive connection to oauth2.googleapis.com, and
+# the per-token refresh locks already serialize access to it.
+_REFRESH_TRANSPORT = Request(session=requests.Session())
+
+# --- Token Cache ---
+# tool_context.state is per-session; this process-wide cache lets parallel
+# tool calls and fresh sessions for the same user reuse live Credentials
+# instead of re-parsing the session JSON. Keyed by a hash of the refresh
+# token so raw credential material never doubles as a dict key. The per-key
+# lock serializes refreshes so concurrent tool calls share one /token request.
+_TOKEN_CACHE: dict[str, Credentials] = {}
+_REFRESH_LOCKS: defaultdict[str, threading.Lock] = defaultdict(threading.Lock)
+
+@functools.lru_cache(maxsize=32)
+def _token_cache_key(refresh_token: str) -> str:
+    return hashlib.sha256(refresh_token.encode()).hexdigest()
+
+def _needs_refresh(creds: Credentials) -> bool:
+    """True when the token is invalid, expired, or inside the refresh leeway
+    window before expiry."""
+    if not creds.valid:
+        return True
+    return bool(
+        creds.expiry
+        and (creds.expiry - datetime.utcnow()).total_seconds() < TOKEN_REFRESH_LEEWAY_SECS
+    )
+
+# --- Service Cache ---
+# Building a discovery client is expensive (discovery parsing plus Resource
+# construction), so reuse one service per access token instead of rebuilding
+# it on every tool call.
+_SERVICE_CACHE: dict[str, Resource] = {}
+
+def _get_chat_service(creds: Credentials) -> Resource:
+    """Returns a cached Chat API service for these credentials, building one if needed."""
+    key = creds.token
+    service = _SERVICE_CACHE.get(key)
+    if service is None:
+        service = build(
+            "chat", "v1", credentials=creds,
+            cache_discovery=False, static_discovery=True,
+        )
+        _SERVICE_CACHE[key] = service
+    return service
+
+# httplib2.Http is not thread-safe, so the keepalive transport is per worker
+# thread: parallel tool calls each get their own TLS connection, while thread
+# reuse in the executor pool keeps those connections warm across pages and
+# tool calls. (The httplib2 stack has no HTTP/2; connection reuse is the
+# available win.) Requests pass this explicitly via execute(http=...), so the
+# service object's own transport is never shared between threads.
+_THREAD_HTTP = threading.local()
+
+def _thread_http(creds: Credentials) -> google_auth_httplib2.AuthorizedHttp:
+    """Returns the calling thread's keepalive transport for these credentials."""
+    by_token = getattr(_THREAD_HTTP, "by_token", None)
+    if by_token is None:
+        by_token = _THREAD_HTTP.by_token = {}
+    authed_http = by_token.get(creds.token)
+    if authed_http is None:
+        authed_http = google_auth_httplib2.AuthorizedHttp(
+            creds, http=httplib2.Http(timeout=60)
+        )
+        by_token[creds.token] = authed_http
+    return authed_http
 
 # --- Centralized Authentication Helper ---
 def get_credentials(tool_context: ToolContext) -> Optional[Credentials]:
@@ -50,27 +133,46 @@ def get_credentials(tool_context: ToolContext) -> Optional[Credentials]:
     """
     creds = None
     if cached_token_info := tool_context.state.get(TOKEN_CACHE_KEY):
-        try:
-            creds = Credentials.from_authorized_user_info(cached_token_info, SCOPES)
-        except Exception as e:
-            print(f"Error loading cached credentials: {e}. Clearing cache.")
-            tool_context.state.pop(TOKEN_CACHE_KEY, None)
-
-    if creds and not creds.valid:
-        if creds.expired and creds.refresh_token:
+        if refresh_token := cached_token_info.get("refresh_token"):
+            creds = _TOKEN_CACHE.get(_token_cache_key(refresh_token))
+        if creds is None:
             try:
-                creds.refresh(Request())
-                tool_context.state[TOKEN_CACHE_KEY] = json.loads(creds.to_json())
+                creds = Credentials.from_authorized_user_info(cached_token_info, SCOPES)
+                if creds.refresh_token:
+                    _TOKEN_CACHE[_token_cache_key(creds.refresh_token)] = creds
             except Exception as e:
-                print(f"Token refresh failed: {e}. Requesting new auth.")
-                creds = None
+                print(f"Error loading cached credentials: {e}. Clearing cache.")
+                tool_context.state.pop(TOKEN_CACHE_KEY, None)
+
+    # Refresh proactively when the token is close to expiry, not just once it
+    # has already expired, so the next API call doesn't race the deadline.
+    if creds and _needs_refresh(creds):
+        if creds.refresh_token:
+            cache_key = _token_cache_key(creds.refresh_token)
+            with _REFRESH_LOCKS[cache_key]:
+                # Double-checked: a concurrent tool call may have refreshed
+                # this token while we waited for the lock, so re-read and
+                # re-test before hitting /token again.
+                creds = _TOKEN_CACHE.get(cache_key, creds)
+                if _needs_refresh(creds):
+                    try:
+                        stale_token = creds.token
+                        creds.refresh(_REFRESH_TRANSPORT)
+                        _SERVICE_CACHE.pop(stale_token, None)
+                        _TOKEN_CACHE[cache_key] = creds
+                        tool_context.state[TOKEN_CACHE_KEY] = orjson.loads(creds.to_json())
+                    except Exception as e:
+                        print(f"Token refresh failed: {e}. Requesting new auth.")
+                        _TOKEN_CACHE.pop(cache_key, None)
+                        creds = None
+                else:
+                    # Another caller refreshed; just sync the session cache.
+                    tool_context.state[TOKEN_CACHE_KEY] = orjson.loads(creds.to_json())
         else:
             creds = None
 
     if not creds:
-        if exchanged_credential := tool_context.get_auth_response(
-            AuthConfig(auth_scheme=auth_scheme, raw_auth_credential=auth_credential)
-        ):
+        if exchanged_credential := tool_context.get_auth_response(_AUTH_CONFIG):
             creds = Credentials(
                 token=exchanged_credential.oauth2.access_token,
                 refresh_token=exchanged_credential.oauth2.refresh_token,
@@ -79,39 +181,104 @@ def get_credentials(tool_context: ToolContext) -> Optional[Credentials]:
                 client_secret=auth_credential.oauth2.client_secret,
                 scopes=SCOPES,
             )
-            tool_context.state[TOKEN_CACHE_KEY] = json.loads(creds.to_json())
+            if creds.refresh_token:
+                _TOKEN_CACHE[_token_cache_key(creds.refresh_token)] = creds
+            tool_context.state[TOKEN_CACHE_KEY] = orjson.loads(creds.to_json())
 
     if not creds:
-        tool_context.request_credential(
-            AuthConfig(auth_scheme=auth_scheme, raw_auth_credential=auth_credential)
-        )
+        tool_context.request_credential(_AUTH_CONFIG)
         return None
     
     return creds
 
+def _force_refresh(tool_context: ToolContext, creds: Credentials) -> bool:
+    """
+    Refreshes creds even though they look valid locally — the server has
+    already rejected them. Returns False when the refresh itself fails.
+    """
+    cache_key = _token_cache_key(creds.refresh_token)
+    rejected_token = creds.token
+    with _REFRESH_LOCKS[cache_key]:
+        cached = _TOKEN_CACHE.get(cache_key)
+        if cached is not None and cached.token != rejected_token:
+            # A concurrent caller already replaced the rejected token.
+            tool_context.state[TOKEN_CACHE_KEY] = orjson.loads(cached.to_json())
+            return True
+        try:
+            creds.refresh(_REFRESH_TRANSPORT)
+            _TOKEN_CACHE[cache_key] = creds
+            tool_context.state[TOKEN_CACHE_KEY] = orjson.loads(creds.to_json())
+            return True
+        except Exception as e:
+            print(f"Token refresh after 401 failed: {e}. Requesting new auth.")
+            _TOKEN_CACHE.pop(cache_key, None)
+            return False
+
+async def _execute_with_retry(tool_context: ToolContext, creds: Credentials, build_request) -> dict:
+    """
+    Executes a Chat API request in a worker thread. When the server rejects
+    the access token (401 — revoked, or raced a rotation), refresh once,
+    rebuild the request against the fresh service, and retry exactly once so
+    the LLM never burns a turn reasoning about a retryable auth error.
+    build_request takes a service and returns an unexecuted request.
+    """
+    request = build_request(_get_chat_service(creds))
+    try:
+        return await asyncio.to_thread(lambda: request.execute(http=_thread_http(creds)))
+    except HttpError as e:
+        if e.resp.status != 401:
+            raise
+        _SERVICE_CACHE.pop(creds.token, None)
+        if not (creds.refresh_token and await asyncio.to_thread(_force_refresh, tool_context, creds)):
+            # Unrecoverable in-flight; clear the session cache so the next
+            # get_credentials call restarts the interactive flow.
+            tool_context.state.pop(TOKEN_CACHE_KEY, None)
+            raise
+        request = build_request(_get_chat_service(creds))
+        return await asyncio.to_thread(lambda: request.execute(http=_thread_http(creds)))
+
 # --- Robust Tool Functions ---
-def search_all_chat_spaces(display_name_query: str, tool_context: ToolContext) -> dict:
+# The tools are coroutines so the blocking googleapiclient calls run in a
+# worker thread instead of stalling the runner's event loop.
+async def _iter_spaces(tool_context: ToolContext, creds: Credentials, space_filter: str):
+    """Yields matching spaces page by page, so callers can stop early without
+    fetching (or holding) the full space list."""
+    page_token = None
+    while True:
+        def build_request(service, page_token=page_token):
+            return service.spaces().list(
+                pageSize=1000, pageToken=page_token, filter=space_filter,
+                fields="nextPageToken,spaces(name,displayName)",
+            )
+        response = await _execute_with_retry(tool_context, creds, build_request)
+        for space in response.get("spaces", []):
+            yield space
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return
+
+async def search_all_chat_spaces(display_name_query: str, tool_context: ToolContext) -> dict:
     """
     Searches through ALL of a user's Google Chat spaces and filters them by a display name query.
     This tool handles authentication and pagination automatically.
     """
-    if not (creds := get_credentials(tool_context)):
+    if not (creds := await asyncio.to_thread(get_credentials, tool_context)):
         return {"status": "pending", "message": "Awaiting user authentication."}
     try:
-        service = build("chat", "v1", credentials=creds)
-        all_spaces, page_token = [], None
-        while True:
-            response = service.spaces().list(pageSize=1000, pageToken=page_token).execute()
-            all_spaces.extend(response.get("spaces", []))
-            page_token = response.get("nextPageToken")
-            if not page_token:
+        # Match on the server so we only page through candidate spaces instead
+        # of the user's entire space list. The filter DSL uses double-quoted
+        # strings, so escape quotes/backslashes in the user-supplied query.
+        escaped_query = display_name_query.replace("\\", "\\\\").replace('"', '\\"')
+        space_filter = f'spaceType = "SPACE" AND displayName:"{escaped_query}"'
+        filtered_spaces = []
+        append = filtered_spaces.append
+        max_results = MAX_SPACE_RESULTS
+        found = 0
+        async for space in _iter_spaces(tool_context, creds, space_filter):
+            append({"displayName": space.get("displayName"), "name": space.get("name")})
+            found += 1
+            if found >= max_results:
                 break
-        
-        filtered_spaces = [
-            {"displayName": space.get("displayName"), "name": space.get("name")}
-            for space in all_spaces
-            if display_name_query.lower() in space.get("displayName", "").lower()
-        ]
 
         if not filtered_spaces:
             return {"status": "success", "message": "No chat spaces found matching your query."}
@@ -120,37 +287,140 @@ def search_all_chat_spaces(display_name_query: str, tool_context: ToolContext) -
     except HttpError as e:
         return {"status": "error", "message": f"An API error occurred: {e.reason}"}
 
-def list_space_messages(parent: str, tool_context: ToolContext, filter: Optional[str] = None) -> dict:
+async def list_space_messages(
+    parent: str,
+    tool_context: ToolContext,
+    filter: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    from_user: Optional[str] = None,
+) -> dict:
     """
     Lists messages in a given Google Chat space, handling pagination.
     'parent' is the resource name of the space, e.g., 'spaces/AAAAAAAAAAA'.
-    'filter' can be used to search messages, e.g., 'from:me "important"'.
+    'since' and 'until' bound the message createTime with RFC 3339 timestamps,
+    e.g. '2024-01-01T00:00:00+00:00'. 'from_user' restricts to one sender,
+    e.g. 'users/example@example.com'. Prefer these over post-filtering: they
+    are applied by the server, so only relevant messages are returned.
+    'filter' takes a raw Chat API filter expression for anything more complex.
     """
-    if not (creds := get_credentials(tool_context)):
+    if not (creds := await asyncio.to_thread(get_credentials, tool_context)):
         return {"status": "pending", "message": "Awaiting user authentication."}
+
+    # Fold the typed parameters into one server-side filter expression.
+    filter_parts = []
+    if since:
+        filter_parts.append(f'createTime > "{since}"')
+    if until:
+        filter_parts.append(f'createTime < "{until}"')
+    if from_user:
+        filter_parts.append(f'sender = "{from_user}"')
+    if filter:
+        filter_parts.append(filter)
+    combined_filter = " AND ".join(filter_parts)
     try:
-        service = build("chat", "v1", credentials=creds)
-        all_messages, page_token = [], None
-        while len(all_messages) < 500: # Limit to 500 messages to protect context window
-            page_size = min(500 - len(all_messages), 1000)
+        def _page_request(service: Resource, page_token: Optional[str], page_size: int):
             request_args = {
                 'parent': parent, 'pageSize': page_size,
-                'orderBy': "createTime DESC", 'pageToken': page_token
+                'orderBy': "createTime DESC", 'pageToken': page_token,
+                # Only request the fields we flatten below; full message
+                # resources carry annotations/cards metadata we never read.
+                'fields': "nextPageToken,messages(sender/displayName,text,createTime)"
             }
-            if filter:
-                request_args['filter'] = filter
-            response = service.spaces().messages().list(**request_args).execute()
+            if combined_filter:
+                request_args['filter'] = combined_filter
+            return service.spaces().messages().list(**request_args)
+
+        def _fetch_page(page_token: Optional[str], page_size: int):
+            return _execute_with_retry(
+                tool_context, creds,
+                lambda service: _page_request(service, page_token, page_size),
+            )
+
+        # Columnar result: three parallel lists instead of one dict per
+        # message, so a 500-message page run allocates three lists rather
+        # than 500 dicts (and serializes smaller, with the keys stated once).
+        authors, texts, times = [], [], []
+        remaining = 500  # Limit to 500 messages to protect context window
+        next_page = asyncio.create_task(_fetch_page(None, min(remaining, 1000)))
+        while next_page is not None:
+            response = await next_page
             messages = response.get('messages', [])
+            page_token = response.get('nextPageToken')
+            remaining -= len(messages)
+            # Kick off the next page before flattening this one, so the network
+            # round-trip overlaps the Python-side processing. create_task only
+            # schedules the coroutine; yield once so it runs up to its executor
+            # hand-off (i.e. the request is actually on the wire) before the
+            # flattening loop below, which never yields.
+            if page_token and remaining > 0:
+                next_page = asyncio.create_task(
+                    _fetch_page(page_token, min(remaining, 1000))
+                )
+                await asyncio.sleep(0)
+            else:
+                next_page = None
             for msg in messages:
-                all_messages.append({
+                authors.append(msg.get("sender", {}).get("displayName"))
+                texts.append(msg.get("text"))
+                times.append(msg.get("createTime"))
+        return {
+            "message_count": len(texts),
+            "messages": {"author": authors, "text": texts, "createTime": times},
+        }
+    except HttpError as e:
+        return {"status": "error", "message": f"An API error occurred: {e.reason}"}
+
+async def list_messages_across_spaces(parents: list[str], tool_context: ToolContext, filter: Optional[str] = None) -> dict:
+    """
+    Lists recent messages from SEVERAL Google Chat spaces in a single batched API call.
+    'parents' is a list of space resource names, e.g. ['spaces/AAAAAAAAAAA', 'spaces/BBBBBBBBBBB'].
+    'filter' can be used to search messages, e.g., 'createTime > "2024-01-01T00:00:00Z"'.
+    Returns up to 100 messages per space. Use list_space_messages for a deep dive into one space.
+    """
+    if not (creds := await asyncio.to_thread(get_credentials, tool_context)):
+        return {"status": "pending", "message": "Awaiting user authentication."}
+    try:
+        # The LLM may repeat a space ID, and batch request_ids must be unique.
+        parents = list(dict.fromkeys(parents))
+        messages_by_space: dict[str, list] = {}
+        errors_by_space: dict[str, str] = {}
+
+        def _collect(request_id, response, exception):
+            if exception is not None:
+                errors_by_space[request_id] = str(exception)
+                return
+            messages_by_space[request_id] = [
+                {
                     "author": msg.get("sender", {}).get("displayName"),
                     "text": msg.get("text"),
-                    "createTime": msg.get("createTime")
-                })
-            page_token = response.get('nextPageToken')
-            if not page_token:
-                break
-        return {"messages": all_messages}
+                    "createTime": msg.get("createTime"),
+                }
+                for msg in response.get("messages", [])
+            ]
+
+        # One HTTP round-trip carries all per-space list calls instead of one
+        # request per space.
+        def _build_batch(service):
+            messages_by_space.clear()
+            errors_by_space.clear()
+            batch = service.new_batch_http_request(callback=_collect)
+            for parent in parents:
+                request_args = {
+                    "parent": parent, "pageSize": 100, "orderBy": "createTime DESC",
+                    "fields": "messages(sender/displayName,text,createTime)",
+                }
+                if filter:
+                    request_args["filter"] = filter
+                batch.add(service.spaces().messages().list(**request_args), request_id=parent)
+            return batch
+
+        await _execute_with_retry(tool_context, creds, _build_batch)
+
+        result = {"status": "success", "messages_by_space": messages_by_space}
+        if errors_by_space:
+            result["errors_by_space"] = errors_by_space
+        return result
     except HttpError as e:
         return {"status": "error", "message": f"An API error occurred: {e.reason}"}
 
@@ -164,9 +434,23 @@ message_analysis_agent = LlmAgent(
         "You are a specialist in analyzing Google Chat messages. "
         "Use the `list_space_messages` tool to retrieve messages and then "
         "answer the user's question based on their content. "
+        "Its result is columnar: `messages` holds parallel `author`, `text` "
+        "and `createTime` lists, where index i across the three lists "
+        "describes one message. "
+        "When the user's question implies a time range or a specific sender "
+        "(e.g. 'yesterday', 'last week', 'messages from Sam'), pass the "
+        "`since`/`until`/`from_user` parameters so the server only returns "
+        "relevant messages, instead of fetching everything and filtering "
+        "yourself. "
+        "When the question covers MORE THAN ONE space, prefer the "
+        "`list_messages_across_spaces` tool with the full list of space IDs — "
+        "it fetches all of them in one batched request. "
         "Provide concise and relevant answers."
     ),
-    tools=[FunctionTool(func=list_space_messages)],
+    tools=[
+        FunctionTool(func=list_space_messages),
+        FunctionTool(func=list_messages_across_spaces),
+    ],
 )
 
 # 2. The "Orchestrator" Agent for routing and simple tasks
@@ -1,14 +1,19 @@
 # cli.py
 import asyncio
+import sqlite3
+import sys
+from pathlib import Path
 from urllib.parse import urlencode
 from dotenv import load_dotenv
+import orjson
 import os
+from prompt_toolkit import PromptSession
 
 # Load environment variables BEFORE importing agent.py
 load_dotenv()
 
 # Import the final agent we want to run
-from agent import orchestrator_agent
+from agent import orchestrator_agent, TOKEN_CACHE_KEY
 # Import the base Runner and InMemorySessionService
 from google.adk.runners import Runner
 from google.adk.sessions import InMemorySessionService, Session
@@ -16,12 +21,62 @@ from google.genai import types
 from helpers import get_auth_request_function_call, get_auth_config
 
 REDIRECT_URI = "http://localhost:8000/callback"
+# Tokens persisted here survive CLI restarts, so a new run costs at most one
+# refresh call instead of the full interactive browser flow.
+TOKEN_DB_PATH = Path(
+    os.environ.get("ADK_CHAT_TOKEN_DB", Path.home() / ".config" / "adk-chat" / "tokens.db")
+)
+
+def _open_token_db() -> sqlite3.Connection:
+    """Opens (creating if needed) the on-disk token store."""
+    TOKEN_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(TOKEN_DB_PATH)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS tokens (user_id TEXT PRIMARY KEY, json TEXT NOT NULL)"
+    )
+    return conn
+
+def _load_persisted_tokens(conn: sqlite3.Connection, user_id: str) -> dict | None:
+    row = conn.execute("SELECT json FROM tokens WHERE user_id = ?", (user_id,)).fetchone()
+    if not row:
+        return None
+    try:
+        return orjson.loads(row[0])
+    except orjson.JSONDecodeError:
+        return None
+
+def _persist_tokens(conn: sqlite3.Connection, user_id: str, token_info: dict) -> None:
+    conn.execute(
+        "INSERT OR REPLACE INTO tokens (user_id, json) VALUES (?, ?)",
+        (user_id, orjson.dumps(token_info).decode()),
+    )
+    conn.commit()
+
+# prompt_toolkit reads natively on the asyncio loop (no executor thread per
+# prompt) and cancels cleanly on Ctrl-C; it needs a real terminal, so piped
+# input falls back to plain input() in the executor.
+_PROMPT_SESSION = PromptSession() if sys.stdin.isatty() else None
 
 async def get_user_input(prompt: str) -> str:
     """Asynchronously gets input from the console."""
+    if _PROMPT_SESSION is not None:
+        return await _PROMPT_SESSION.prompt_async(prompt)
     loop = asyncio.get_running_loop()
     return await loop.run_in_executor(None, input, prompt)
 
+async def _stream_events(events_async) -> types.FunctionCall | None:
+    """Prints streamed agent text as it arrives and returns the auth request
+    function call if the agent asks for credentials, else None."""
+    write, flush = sys.stdout.write, sys.stdout.flush
+    async for event in events_async:
+        if text := (event.content.parts[0].text if event.content and event.content.parts else None):
+            write(text)
+            flush()
+        if auth_req := get_auth_request_function_call(event):
+            return auth_req
+    return None
+
 async def handle_agent_run(runner: Runner, session: Session, user_query: str):
     """Handles a single turn of conversation, including the full auth flow if needed."""
     initial_message = types.Content(parts=[types.Part(text=user_query)])
@@ -31,14 +86,8 @@ async def handle_agent_run(runner: Runner, session: Session, user_query: str):
         session_id=session.id, user_id=session.user_id, new_message=initial_message
     )
 
-    auth_request_function_call = None
-    async for event in events_async:
-        if text := (event.content.parts[0].text if event.content and event.content.parts else None):
-            print(text, end="", flush=True)
-        if auth_req := get_auth_request_function_call(event):
-            auth_request_function_call = auth_req
-            break
-    
+    auth_request_function_call = await _stream_events(events_async)
+
     if auth_request_function_call:
         auth_config = get_auth_config(auth_request_function_call)
         base_auth_uri = auth_config.exchanged_auth_credential.oauth2.auth_uri
@@ -75,10 +124,8 @@ async def handle_agent_run(runner: Runner, session: Session, user_query: str):
         events_async_after_auth = runner.run_async(
             session_id=session.id, user_id=session.user_id, new_message=auth_content
         )
-        async for event in events_async_after_auth:
-            if text := (event.content.parts[0].text if event.content and event.content.parts else None):
-                print(text, end="", flush=True)
-    
+        await _stream_events(events_async_after_auth)
+
     print()
 
 async def main():
@@ -98,7 +145,16 @@ async def main():
         session_service=session_service
     )
     
-    session = await session_service.create_session(app_name=app_name, user_id="cli-user")
+    # Pre-seed the in-memory session with any tokens from a previous run, and
+    # write refreshed tokens back after each turn.
+    token_db = _open_token_db()
+    user_id = "cli-user"
+    persisted_token_info = _load_persisted_tokens(token_db, user_id)
+    session = await session_service.create_session(
+        app_name=app_name,
+        user_id=user_id,
+        state={TOKEN_CACHE_KEY: persisted_token_info} if persisted_token_info else None,
+    )
 
     print("--- Google Chat Agent Initialized (Local CLI) ---")
     print("Type 'exit' or 'quit' to end.")
@@ -108,8 +164,16 @@ async def main():
         if user_query.lower() in ["exit", "quit"]:
             print("Ending session. Goodbye!")
             break
-        
+
         await handle_agent_run(runner, session, user_query)
 
+        updated_session = await session_service.get_session(
+            app_name=app_name, user_id=user_id, session_id=session.id
+        )
+        token_info = updated_session.state.get(TOKEN_CACHE_KEY) if updated_session else None
+        if token_info and token_info != persisted_token_info:
+            _persist_tokens(token_db, user_id, token_info)
+            persisted_token_info = token_info
+
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
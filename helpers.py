@@ -8,18 +8,24 @@ def get_auth_request_function_call(event: Event) -> types.FunctionCall | None:
     """
     Get the special auth request function call from the event.
     This signals that the agent needs user authentication to proceed.
+
+    Called once per streamed event, so it is written to bail out as early as
+    possible: most events carry no long-running tool ids, and each pydantic
+    attribute access is read exactly once.
     """
-    if not event.content or not event.content.parts:
+    ids = event.long_running_tool_ids
+    if not ids:
+        return None
+    content = event.content
+    if not content:
+        return None
+    parts = content.parts
+    if not parts:
         return None
-    for part in event.content.parts:
-        if (
-            part
-            and part.function_call
-            and part.function_call.name == 'adk_request_credential'
-            and event.long_running_tool_ids
-            and part.function_call.id in event.long_running_tool_ids
-        ):
-            return part.function_call
+    for part in parts:
+        fc = part.function_call if part else None
+        if fc is not None and fc.name == 'adk_request_credential' and fc.id in ids:
+            return fc
     return None
 
 def get_auth_config(auth_request_function_call: types.FunctionCall) -> AuthConfig: